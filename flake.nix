@@ -32,7 +32,12 @@
           ];
 
           dependencies = with pkgs.python3Packages; [
-            requests
+            aiohttp
+            blake3
+            cachetools
+            diskcache
+            orjson
+            websockets
           ];
 
           meta = {
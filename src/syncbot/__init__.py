@@ -7,18 +7,33 @@ Attachments (images, videos, etc.) are included in the crossposted content.
 """
 
 import os
-import json
-import time
-import mimetypes
+import asyncio
+import logging
+import logging.handlers
+import queue
 import signal
-from typing import List, Dict, Any, Optional, Generator
+import tempfile
+from typing import List, Dict, Any, Optional
 from dataclasses import dataclass
-from datetime import datetime
-import requests
-from requests.exceptions import RequestException
+from datetime import datetime, timezone
+import orjson
 
+from .clients import MastodonClient, MediaRejectedError, MisskeyClient
+from .notes import misskey_to_mastodon_visibility, should_crosspost
 
-@dataclass
+logger = logging.getLogger("syncbot")
+
+# Where the latest processed note ID is persisted between runs
+STATE_FILE = "crosspost_state.json"
+
+# Minimum number of seconds between two writes of the state file
+STATE_SAVE_INTERVAL = 5.0
+
+# Maximum number of media attachments Mastodon accepts on a status
+MAX_MEDIA_ATTACHMENTS = 4
+
+
+@dataclass(slots=True, frozen=True)
 class Config:
     """Configuration for the Misskey to Mastodon crossposter."""
 
@@ -33,229 +48,120 @@ class Config:
 
     # General configuration
     fetch_limit: int = 20
-    since_id: Optional[str] = None
-    crosspost_delay: int = 2  # Seconds between crossposts to avoid rate limits
-
-
-class MisskeyClient:
-    """Client for interacting with the Misskey API."""
-
-    def __init__(self, instance: str, token: str):
-        self.instance = instance.rstrip("/")
-        self.token = token
-        self.base_url = f"{self.instance}/api"
-        self._running = True
-
-    def _make_request(self, endpoint: str, data: Dict[str, Any]) -> Dict[str, Any]:
-        """Make a request to the Misskey API."""
-        url = f"{self.base_url}/{endpoint}"
-        headers = {"Content-Type": "application/json"}
-        data["i"] = self.token
-
-        response = requests.post(url, headers=headers, json=data, timeout=10)
-        response.raise_for_status()
-        return response.json()
-
-    def get_user_notes(
-        self, user_id: str, limit: int = 20, since_id: Optional[str] = None
-    ) -> List[Dict[str, Any]]:
-        """Get notes (posts) from a specific user."""
-        data = {
-            "userId": user_id,
-            "limit": limit,
-            "includeReplies": False,  # We don't want replies
-            "includeMyRenotes": False,  # We don't want renotes (quotes)
-        }
-
-        if since_id:
-            data["sinceId"] = since_id
-
-        return self._make_request("users/notes", data)
-
-    def download_attachment(self, file_url: str) -> tuple[bytes, str, str]:
-        """Download a file attachment from Misskey."""
-        if not file_url.startswith("http"):
-            file_url = f"{self.instance}/{file_url.lstrip('/')}"
-
-        response = requests.get(file_url, timeout=10)
-        response.raise_for_status()
-
-        # Get the content type and generate a filename
-        content_type = response.headers.get("Content-Type", "application/octet-stream")
-        extension = mimetypes.guess_extension(content_type) or ""
-        filename = f"attachment_{int(time.time())}_{hash(file_url) % 10000}{extension}"
-
-        return response.content, filename, content_type
-
-    def stream_notes(
-        self, user_id: str, since_id: Optional[str] = None
-    ) -> Generator[Dict[str, Any], None, None]:
-        """Stream notes from a specific user in real-time."""
-        while self._running:
-            try:
-                notes = self.get_user_notes(user_id, limit=10, since_id=since_id)
-                if notes:
-                    for note in notes:
-                        if since_id is None or note["id"] != since_id:
-                            yield note
-                            since_id = note["id"]
-                time.sleep(5)  # Wait 5 seconds before checking again
-            except RequestException as e:
-                print(f"Error streaming notes: {str(e)}")
-                time.sleep(30)  # Wait longer on error before retrying
-                continue
-
-    def stop_streaming(self):
-        """Stop the note streaming."""
-        self._running = False
-
-
-class MastodonClient:
-    """Client for interacting with the Mastodon API."""
-
-    def __init__(self, instance: str, token: str):
-        self.instance = instance.rstrip("/")
-        self.token = token
-        self.base_url = f"{self.instance}/api/v1"
-        self.headers = {"Authorization": f"Bearer {self.token}"}
-
-    def _make_request(self, method: str, endpoint: str, **kwargs) -> Dict[str, Any]:
-        """Make a request to the Mastodon API."""
-        url = f"{self.base_url}/{endpoint}"
-
-        if "headers" not in kwargs:
-            kwargs["headers"] = self.headers
-        else:
-            kwargs["headers"].update(self.headers)
-
-        response = requests.request(method, url, **kwargs, timeout=10)
-        response.raise_for_status()
-        return response.json() if response.content else {}
-
-    def upload_media(
-        self,
-        file_content: bytes,
-        filename: str,
-        mime_type: str,
-        description: Optional[str] = None,
-    ) -> Dict[str, Any]:
-        """Upload media to Mastodon."""
-        endpoint = "media"
-
-        files = {"file": (filename, file_content, mime_type)}
-
-        data = {}
-        if description:
-            data["description"] = description
-
-        return self._make_request("POST", endpoint, files=files, data=data)
-
-    def create_status(
-        self, text: str, media_ids: List[str] = None, visibility: str = "public", spoiler_text: Optional[str] = None
-    ) -> Dict[str, Any]:
-        """Create a new status (post) on Mastodon."""
-        endpoint = "statuses"
-
-        data = {
-            "status": text,
-            "visibility": visibility,
-            "content_type": "text/markdown",
-        }
-
-        if media_ids:
-            data["media_ids"] = media_ids
-
-        if spoiler_text:
-            data["spoiler_text"] = spoiler_text
-
-        return self._make_request("POST", endpoint, json=data)
-
-
-def should_crosspost(note: Dict[str, Any]) -> bool:
-    """Determine if a note should be crossposted based on our criteria."""
-    # Don't crosspost if it's a reply
-    if note.get("replyId") is not None:
-        return False
-
-    # Don't crosspost if it's a quote (renote with text) or a renote
-    if note.get("renoteId") is not None:
-        return False
-
-    # Don't crosspost if it contains mentions
-    if note.get("mentions") and len(note.get("mentions")) > 0:
-        return False
-
-    # Check if text contains @ symbol (might be a mention)
-    if note.get("text") and "@" in note.get("text", ""):
-        return False
-
-    return True
-
-def misskey_to_mastodon_visibility(misskey_visibility: str) -> str:
-    """Convert Misskey visibility to Mastodon visibility."""
-    visibility_map = {
-        "public": "public",
-        "followers": "private",
-        "specified": "direct",
-        "home": "unlisted",
-    }
-    return visibility_map.get(misskey_visibility, "public")
+    max_parallel_uploads: int = 4  # Attachments transferred concurrently per note
+
+
+@dataclass(slots=True)
+class StreamState:
+    """Runtime state of the crossposter, persisted between runs."""
+
+    since_id: Optional[str] = None  # Latest processed note ID
 
-def process_misskey_files(
+
+async def transfer_file(
     misskey_client: MisskeyClient,
     mastodon_client: MastodonClient,
-    files: List[Dict[str, Any]],
-) -> List[str]:
-    """Process Misskey files and upload them to Mastodon."""
-    media_ids = []
+    file: Dict[str, Any],
+) -> str:
+    """Copy a single Misskey file to Mastodon and return its media ID."""
+    # Download the file from Misskey
+    stream, filename, mime_type = await misskey_client.download_attachment(file["url"])
+
+    # Upload to Mastodon
+    with stream:
+        description = file.get("comment")
+        media = await mastodon_client.upload_media(
+            stream, filename, mime_type, description
+        )
+    logger.debug("Uploaded file %s as media %s", filename, media["id"])
+    return media["id"]
 
-    for file in files:
-        try:
-            # Download the file from Misskey
-            file_content, filename, mime_type = misskey_client.download_attachment(
-                file["url"]
-            )
 
-            # Upload to Mastodon
-            description = file.get("comment")
-            media = mastodon_client.upload_media(
-                file_content, filename, mime_type, description
-            )
-            media_ids.append(media["id"])
+async def process_misskey_files(
+    misskey_client: MisskeyClient,
+    mastodon_client: MastodonClient,
+    files: List[Dict[str, Any]],
+    max_parallel_uploads: int = 4,
+) -> List[str]:
+    """Process Misskey files and upload them to Mastodon.
 
-            # Wait a bit to avoid rate limits
-            time.sleep(1)
+    Files are transferred concurrently, but the returned media IDs keep the
+    order of ``files``. Files that fail are skipped, except when Mastodon
+    rejects an upload (MediaRejectedError): that is raised right away and the
+    remaining transfers are cancelled, as retrying them would fail the same way.
+    """
+    semaphore = asyncio.Semaphore(max_parallel_uploads)
 
-        except Exception as e:  # pylint: disable=broad-exception-caught
-            print(f"Error processing file {file.get('name', 'unknown')}: {str(e)}")
+    async def transfer(file: Dict[str, Any]) -> Optional[str]:
+        async with semaphore:
+            try:
+                return await transfer_file(misskey_client, mastodon_client, file)
+            except MediaRejectedError:
+                raise
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logger.error(
+                    "Error processing file %s: %s", file.get("name", "unknown"), e
+                )
+            return None
+
+    # Files past Mastodon's limit would only be rejected when creating the status
+    if len(files) > MAX_MEDIA_ATTACHMENTS:
+        logger.warning(
+            "Dropping %d attachments past Mastodon's limit of %d",
+            len(files) - MAX_MEDIA_ATTACHMENTS,
+            MAX_MEDIA_ATTACHMENTS,
+        )
+    tasks = [
+        asyncio.create_task(transfer(file)) for file in files[:MAX_MEDIA_ATTACHMENTS]
+    ]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
 
-    return media_ids
+    return [media_id for media_id in results if media_id is not None]
 
 
-def crosspost(config: Config):
+async def crosspost(config: Config, state: StreamState):
     """Main function to handle crossposting from Misskey to Mastodon."""
-    misskey_client = MisskeyClient(config.misskey_instance, config.misskey_token)
-    mastodon_client = MastodonClient(config.mastodon_instance, config.mastodon_token)
+    async with (
+        MisskeyClient(
+            config.misskey_instance, config.misskey_token
+        ) as misskey_client,
+        MastodonClient(
+            config.mastodon_instance, config.mastodon_token
+        ) as mastodon_client,
+    ):
 
-    # Get recent notes from the user
-    notes = misskey_client.get_user_notes(
-        config.misskey_user_id, config.fetch_limit, config.since_id
-    )
+        # Get recent notes from the user
+        notes = await misskey_client.get_user_notes(
+            config.misskey_user_id, config.fetch_limit, state.since_id
+        )
 
-    # Process newer posts first (notes are typically returned in reverse chronological order)
-    newest_id = None
-    for note in notes:
-        if newest_id is None:
-            newest_id = note["id"]
+        # Process newer posts first (notes are typically returned in reverse chronological order)
+        newest_id = notes[0]["id"] if notes else None
+        candidates = [note for note in notes if should_crosspost(note)]
+
+        # Transfer the attachments of every note up front, so that uploads for
+        # later notes overlap with creating the statuses for earlier ones
+        media_tasks = [
+            asyncio.create_task(
+                process_misskey_files(
+                    misskey_client,
+                    mastodon_client,
+                    note.get("files") or [],
+                    config.max_parallel_uploads,
+                )
+            )
+            for note in candidates
+        ]
 
-        if should_crosspost(note):
+        # Statuses are still created one by one to keep their order
+        for note, media_task in zip(candidates, media_tasks):
             try:
-                # Process attachments if any
-                media_ids = []
-                if "files" in note and note["files"]:
-                    media_ids = process_misskey_files(
-                        misskey_client, mastodon_client, note["files"]
-                    )
+                media_ids = await media_task
 
                 # Create the post on Mastodon
                 text = note.get("text", "")
@@ -266,14 +172,13 @@ def crosspost(config: Config):
 
                 spoiler_text = note.get("cw")
 
-                mastodon_client.create_status(text, media_ids, visibility, spoiler_text)
-                print(f"Successfully crossposted note {note['id']}")
-
-                # Wait between posts to avoid rate limits
-                time.sleep(config.crosspost_delay)
+                await mastodon_client.create_status(
+                    text, media_ids, visibility, spoiler_text
+                )
+                logger.info("Successfully crossposted note %s", note["id"])
 
             except Exception as e:  # pylint: disable=broad-exception-caught
-                print(f"Error crossposting note {note['id']}: {str(e)}")
+                logger.error("Error crossposting note %s: %s", note["id"], e)
 
     # Return the newest ID for the next run
     return newest_id
@@ -291,7 +196,7 @@ def load_config() -> Config:
         "mastodon_instance": os.environ.get("MASTODON_INSTANCE"),
         "mastodon_token": os.environ.get("MASTODON_TOKEN"),
         "fetch_limit": int(os.environ.get("FETCH_LIMIT", "20")),
-        "crosspost_delay": int(os.environ.get("CROSSPOST_DELAY", "2")),
+        "max_parallel_uploads": int(os.environ.get("MAX_PARALLEL_UPLOADS", "4")),
     }
 
     # If any required config is missing, try to load from config file
@@ -307,14 +212,14 @@ def load_config() -> Config:
         config_file = os.environ.get("CONFIG_FILE", "config.json")
 
         try:
-            with open(config_file, "r", encoding="utf-8") as f:
-                file_config = json.load(f)
-                # Update missing values from file
+            with open(config_file, "rb") as f:
+                file_config = orjson.loads(f.read())
+                # Update missing values from file, ignoring unknown keys
                 for key, value in file_config.items():
-                    if config_dict.get(key) is None:
+                    if key in config_dict and config_dict[key] is None:
                         config_dict[key] = value
-        except (FileNotFoundError, json.JSONDecodeError) as e:
-            print(f"Error loading config file: {str(e)}")
+        except (FileNotFoundError, orjson.JSONDecodeError) as e:
+            logger.error("Error loading config file: %s", e)
 
     # Validate that all required fields are present
     missing_fields = [
@@ -323,82 +228,291 @@ def load_config() -> Config:
     if missing_fields:
         raise ValueError(f"Missing required configuration: {', '.join(missing_fields)}")
 
-    # Load the since_id from a state file if it exists
-    state_file = "crosspost_state.json"
-    try:
-        with open(state_file, "r", encoding="utf-8") as f:
-            state = json.load(f)
-            config_dict["since_id"] = state.get("since_id")
-    except (FileNotFoundError, json.JSONDecodeError):
-        config_dict["since_id"] = None
+    if config_dict["max_parallel_uploads"] < 1:
+        raise ValueError("max_parallel_uploads must be at least 1")
 
     return Config(**config_dict)
 
 
+def load_state() -> StreamState:
+    """Load the latest processed note ID from the state file, if it exists."""
+    try:
+        with open(STATE_FILE, "rb") as f:
+            state = orjson.loads(f.read())
+            return StreamState(since_id=state.get("since_id"))
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return StreamState()
+
+
 def save_state(since_id: str):
-    """Save the latest processed note ID to a state file."""
-    state_file = "crosspost_state.json"
-    with open(state_file, "w", encoding="utf-8") as f:
-        json.dump({"since_id": since_id, "last_run": datetime.now().isoformat()}, f)
+    """Save the latest processed note ID to a state file.
+
+    The state is written to a temporary file which then replaces the old one,
+    so a crash mid-write never leaves a truncated state file behind.
+    """
+    state_dir = os.path.dirname(os.path.abspath(STATE_FILE))
+    with tempfile.NamedTemporaryFile(
+        "wb", dir=state_dir, suffix=".tmp", delete=False
+    ) as f:
+        try:
+            f.write(
+                orjson.dumps(
+                    {"since_id": since_id, "last_run": datetime.now(timezone.utc)}
+                )
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            f.close()
+            os.unlink(f.name)
+            raise
 
+    os.replace(f.name, STATE_FILE)
 
-def main():
-    """Main entry point for the script."""
-    try:
-        config = load_config()
-        misskey_client = MisskeyClient(config.misskey_instance, config.misskey_token)
-        mastodon_client = MastodonClient(
-            config.mastodon_instance, config.mastodon_token
-        )
 
-        def signal_handler(_signum, _frame):
-            """Handle shutdown signals gracefully."""
-            print("\nShutting down gracefully...")
-            misskey_client.stop_streaming()
+class StateSaver:
+    """Coalesces state file writes to at most one per save interval.
+
+    Processed note IDs are recorded with update(), and run() writes the latest
+    one every interval until stop() is called, after which it writes once more.
+    """
+
+    def __init__(self, interval: float = STATE_SAVE_INTERVAL):
+        self.interval = interval
+        self._pending_id: Optional[str] = None
+        self._last_saved_id: Optional[str] = None
+        self._stopped = asyncio.Event()
+
+    def update(self, since_id: str):
+        """Record the latest processed note ID."""
+        self._pending_id = since_id
+
+    async def flush(self):
+        """Save the latest recorded note ID if it has not been saved yet."""
+        since_id = self._pending_id
+        if since_id is None or since_id == self._last_saved_id:
+            return
+
+        await asyncio.to_thread(save_state, since_id)
+        self._last_saved_id = since_id
+
+    async def run(self):
+        """Periodically save the latest recorded note ID until stopped."""
+        while not self._stopped.is_set():
+            try:
+                await asyncio.wait_for(self._stopped.wait(), self.interval)
+            except TimeoutError:
+                pass
+            await self.flush()
+
+    def stop(self):
+        """Make run() save one last time and return."""
+        self._stopped.set()
+
 
-        # Register signal handlers
-        signal.signal(signal.SIGINT, signal_handler)
-        signal.signal(signal.SIGTERM, signal_handler)
+class CrosspostPipeline:  # pylint: disable=too-many-instance-attributes
+    """Crossposts streamed notes through a chain of queues.
 
-        print("Starting to listen for new notes...")
-        for note in misskey_client.stream_notes(
-            config.misskey_user_id, config.since_id
+    Streamed notes that should be crossposted go on ``notes_q``, from which
+    several media workers transfer the attachments of different notes at once.
+    Every note is also put on ``ready_q`` in stream order, along with a future
+    for its media IDs, so the status poster still creates statuses in order.
+    The IDs of processed notes then go on ``done_q`` to be saved.
+    """
+
+    def __init__(
+        self,
+        config: Config,
+        state: StreamState,
+        misskey_client: MisskeyClient,
+        mastodon_client: MastodonClient,
+        state_saver: StateSaver,
+    ):
+        self.config = config
+        self.state = state
+        self.misskey_client = misskey_client
+        self.mastodon_client = mastodon_client
+        self.state_saver = state_saver
+
+        # Bounded, so that a slow Mastodon instance slows down the stream
+        # instead of letting notes pile up in memory
+        queue_size = 4 * config.max_parallel_uploads
+        self.notes_q: asyncio.Queue[
+            tuple[Dict[str, Any], asyncio.Future[List[str]]]
+        ] = asyncio.Queue(queue_size)
+        self.ready_q: asyncio.Queue[
+            tuple[Dict[str, Any], Optional[asyncio.Future[List[str]]]]
+        ] = asyncio.Queue(queue_size)
+        self.done_q: asyncio.Queue[str] = asyncio.Queue()
+
+    async def produce(self):
+        """Queue notes from the stream until it stops."""
+        loop = asyncio.get_running_loop()
+
+        async for note in self.misskey_client.stream_notes(
+            self.config.misskey_user_id, self.state.since_id
         ):
+            media_future = None
             if should_crosspost(note):
-                try:
-                    # Process attachments if any
-                    media_ids = []
-                    if "files" in note and note["files"]:
-                        media_ids = process_misskey_files(
-                            misskey_client, mastodon_client, note["files"]
-                        )
+                media_future = loop.create_future()
+                if note.get("files"):
+                    await self.notes_q.put((note, media_future))
+                else:
+                    media_future.set_result([])
+
+            await self.ready_q.put((note, media_future))
+
+    async def transfer_media(self):
+        """Transfer the attachments of queued notes."""
+        while True:
+            note, media_future = await self.notes_q.get()
+            try:
+                media_future.set_result(
+                    await process_misskey_files(
+                        self.misskey_client,
+                        self.mastodon_client,
+                        note["files"],
+                        self.config.max_parallel_uploads,
+                    )
+                )
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                media_future.set_exception(e)
+            finally:
+                self.notes_q.task_done()
+
+    async def post_statuses(self):
+        """Create statuses for queued notes, in stream order."""
+        while True:
+            note, media_future = await self.ready_q.get()
+            try:
+                if media_future is not None:
+                    try:
+                        media_ids = await media_future
 
-                    # Create the post on Mastodon
-                    text = note.get("text", "")
+                        # Create the post on Mastodon
+                        text = note.get("text", "")
 
-                    visibility = misskey_to_mastodon_visibility(
-                        note.get("visibility", "public")
-                    )
+                        visibility = misskey_to_mastodon_visibility(
+                            note.get("visibility", "public")
+                        )
 
-                    spoiler_text = note.get("cw")
+                        spoiler_text = note.get("cw")
 
-                    mastodon_client.create_status(text, media_ids, visibility, spoiler_text)
-                    print(f"Successfully crossposted note {note['id']}")
+                        await self.mastodon_client.create_status(
+                            text, media_ids, visibility, spoiler_text
+                        )
+                        logger.info("Successfully crossposted note %s", note["id"])
+
+                    except Exception as e:  # pylint: disable=broad-exception-caught
+                        logger.error("Error crossposting note %s: %s", note["id"], e)
+
+                await self.done_q.put(note["id"])
+            finally:
+                self.ready_q.task_done()
+
+    async def record_progress(self):
+        """Update the since_id as notes are processed."""
+        while True:
+            note_id = await self.done_q.get()
+            self.state.since_id = note_id
+            self.state_saver.update(note_id)
+            self.done_q.task_done()
+
+    async def run(self):
+        """Crosspost notes until the stream stops, then finish queued ones."""
+        async with asyncio.TaskGroup() as task_group:
+            workers = [
+                task_group.create_task(self.transfer_media())
+                for _ in range(self.config.max_parallel_uploads)
+            ]
+            workers.append(task_group.create_task(self.post_statuses()))
+            workers.append(task_group.create_task(self.record_progress()))
+
+            await self.produce()
+
+            await self.ready_q.join()
+            await self.done_q.join()
+            for worker in workers:
+                worker.cancel()
+
+
+async def run():
+    """Listen for new notes and crosspost them until interrupted."""
+    try:
+        config = load_config()
+        state = load_state()
+        async with (
+            MisskeyClient(
+                config.misskey_instance, config.misskey_token
+            ) as misskey_client,
+            MastodonClient(
+                config.mastodon_instance, config.mastodon_token
+            ) as mastodon_client,
+        ):
+            await misskey_client.check_streamable_user(config.misskey_user_id)
+
+            async with asyncio.TaskGroup() as task_group:
+                state_saver = StateSaver()
+                task_group.create_task(state_saver.run())
 
-                    # Wait between posts to avoid rate limits
-                    time.sleep(config.crosspost_delay)
+                def signal_handler():
+                    """Handle shutdown signals gracefully."""
+                    logger.info("Shutting down gracefully...")
+                    task_group.create_task(misskey_client.stop_streaming())
 
-                except Exception as e:  # pylint: disable=broad-exception-caught
-                    print(f"Error crossposting note {note['id']}: {str(e)}")
+                # Register signal handlers
+                loop = asyncio.get_running_loop()
+                loop.add_signal_handler(signal.SIGINT, signal_handler)
+                loop.add_signal_handler(signal.SIGTERM, signal_handler)
 
-            # Update the since_id after processing each note
-            config.since_id = note["id"]
-            save_state(note["id"])
+                logger.info("Starting to listen for new notes...")
+                try:
+                    await CrosspostPipeline(
+                        config, state, misskey_client, mastodon_client, state_saver
+                    ).run()
+                finally:
+                    state_saver.stop()
 
     except Exception as e:  # pylint: disable=broad-exception-caught
-        print(f"Error in main function: {str(e)}")
+        logger.exception("Error in main function: %s", e)
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Route log records through a queue so emitting them never blocks the loop.
+
+    The bot's own level is read from the ``LOG_LEVEL`` environment variable,
+    falling back to INFO if it is unknown; other libraries only log warnings. The returned listener writes the records
+    to stderr and must be stopped on exit.
+    """
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+    listener = logging.handlers.QueueListener(log_queue, handler)
+
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(logging.WARNING)
+    listener.start()
+
+    level = os.environ.get("LOG_LEVEL", "INFO").upper()
+    try:
+        logger.setLevel(level)
+    except ValueError:
+        logger.setLevel(logging.INFO)
+        logger.warning("Unknown LOG_LEVEL %r, using INFO", level)
+
+    return listener
+
+
+def main():
+    """Main entry point for the script."""
+    listener = setup_logging()
+    try:
+        asyncio.run(run())
     finally:
-        misskey_client.stop_streaming()
+        listener.stop()
 
 
 if __name__ == "__main__":
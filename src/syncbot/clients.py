@@ -0,0 +1,672 @@
+"""
+HTTP helpers and the Misskey and Mastodon API clients.
+
+Requests are made over pooled aiohttp sessions, and transient failures are
+retried with exponential backoff (see request_with_retries).
+"""
+
+import asyncio
+import inspect
+import io
+import json
+import logging
+import mimetypes
+import os
+import random
+import shutil
+import socket
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from types import MappingProxyType
+from typing import (
+    List,
+    Dict,
+    Any,
+    Optional,
+    AsyncGenerator,
+    BinaryIO,
+    Callable,
+    Mapping,
+    Union,
+)
+import aiohttp
+import diskcache
+from blake3 import blake3
+from cachetools import TTLCache
+from websockets.asyncio.client import ClientConnection, connect
+from websockets.exceptions import WebSocketException
+
+logger = logging.getLogger(__name__)
+
+# Size of the chunks attachments are streamed in
+CHUNK_SIZE = 64 * 1024
+
+# On-disk cache of downloaded attachments
+ATTACHMENT_CACHE_DIR = ".attachment_cache"
+ATTACHMENT_CACHE_SIZE = 2 << 30  # Bytes
+ATTACHMENT_CACHE_EXPIRY = 30 * 86400  # Seconds
+
+# Retry policy for HTTP requests
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF_FACTOR = 0.3  # Seconds, doubled after every attempt
+RETRY_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# File extensions for common attachment types, so that the mimetypes database
+# only needs to be consulted for rarer ones
+_EXT = MappingProxyType(
+    {
+        "image/jpeg": ".jpg",
+        "image/png": ".png",
+        "image/webp": ".webp",
+        "image/gif": ".gif",
+        "image/avif": ".avif",
+        "video/mp4": ".mp4",
+        "video/webm": ".webm",
+        "audio/mpeg": ".mp3",
+        "audio/ogg": ".ogg",
+        "application/pdf": ".pdf",
+    }
+)
+
+
+class BlockingStreamReader:  # pylint: disable=too-few-public-methods
+    """Blocking file-like view of an aiohttp response body.
+
+    Meant to be read from a worker thread, while the event loop that owns the
+    response keeps running.
+    """
+
+    def __init__(self, content: aiohttp.StreamReader, loop: asyncio.AbstractEventLoop):
+        self.content = content
+        self.loop = loop
+
+    def read(self, size: int = -1) -> bytes:
+        """Read up to ``size`` bytes from the response body."""
+        return asyncio.run_coroutine_threadsafe(
+            self.content.read(size if size > 0 else CHUNK_SIZE), self.loop
+        ).result()
+
+
+class HashingReader:  # pylint: disable=too-few-public-methods
+    """File-like wrapper that hashes everything read through it."""
+
+    def __init__(self, raw: BinaryIO):
+        self.raw = raw
+        self.hasher = blake3()
+
+    def read(self, size: int = -1) -> bytes:
+        """Read from the wrapped file, feeding the data to the hasher."""
+        chunk = self.raw.read(size)
+        self.hasher.update(chunk)
+        return chunk
+
+
+def reopen_file(file: BinaryIO) -> BinaryIO:
+    """Open an independent handle on ``file``, rewound to its start.
+
+    aiohttp closes a request body once it is sent, so every attempt at sending
+    a file needs a handle of its own. Files without a descriptor are copied.
+    """
+    file.seek(0)
+    try:
+        return open(os.dup(file.fileno()), "rb")  # pylint: disable=consider-using-with
+    except OSError:
+        return io.BytesIO(file.read())
+
+
+# aiohttp only accepts a socket factory from 3.12 on. Older versions still
+# disable Nagle's algorithm themselves, but leave TCP keepalive off
+_HAS_SOCKET_FACTORY = (
+    "socket_factory" in inspect.signature(aiohttp.TCPConnector).parameters
+)
+
+
+def create_socket(addr_info: tuple[int, int, int, str, Any]) -> socket.socket:
+    """Create a client socket with TCP keepalive and Nagle's algorithm disabled."""
+    family, type_, proto, _, _ = addr_info
+    sock = socket.socket(family=family, type=type_, proto=proto)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    return sock
+
+
+def create_session(headers: Optional[Dict[str, str]] = None) -> aiohttp.ClientSession:
+    """Create an HTTP session with connection pooling."""
+    connector = aiohttp.TCPConnector(
+        limit=16,
+        limit_per_host=8,
+        keepalive_timeout=60,
+        **({"socket_factory": create_socket} if _HAS_SOCKET_FACTORY else {}),
+    )
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=10)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers)
+
+
+def parse_retry_after(response: aiohttp.ClientResponse) -> Optional[float]:
+    """Get the number of seconds a response's Retry-After header asks to wait."""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+async def request_with_retries(
+    session: aiohttp.ClientSession,
+    method: str,
+    url: str,
+    *,
+    idempotent: Optional[bool] = None,
+    data: Union[Any, Callable[[], Any]] = None,
+    **kwargs,
+) -> aiohttp.ClientResponse:
+    """Make a request, retrying transient failures with exponential backoff.
+
+    Failures to connect and 429 responses are retried for every method, since
+    the request was not processed. Other connection errors and retryable
+    statuses are only retried for idempotent requests, honouring any
+    Retry-After header. Whether a request is idempotent follows from its
+    method, unless ``idempotent`` says otherwise (e.g. for read-only POSTs).
+
+    ``data`` may be a callable that builds the body anew for every attempt, for
+    bodies that can only be sent once, such as files.
+
+    The response is returned unread; the caller is responsible for releasing it.
+    """
+    if idempotent is None:
+        idempotent = method in RETRY_METHODS
+    attempt = 0
+
+    while True:
+        delay = RETRY_BACKOFF_FACTOR * 2**attempt
+        try:
+            response = await session.request(
+                method, url, data=data() if callable(data) else data, **kwargs
+            )
+        except (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError):
+            if attempt >= RETRY_ATTEMPTS:
+                raise
+        except aiohttp.ClientConnectionError:
+            if not idempotent or attempt >= RETRY_ATTEMPTS:
+                raise
+        else:
+            if (
+                response.status not in RETRY_STATUSES
+                or not (idempotent or response.status == 429)
+                or attempt >= RETRY_ATTEMPTS
+            ):
+                return response
+            delay = max(delay, parse_retry_after(response) or 0.0)
+            response.release()
+
+        # Jitter keeps concurrent retries from hitting the server in lockstep
+        await asyncio.sleep(delay + random.uniform(0, RETRY_BACKOFF_FACTOR))
+        attempt += 1
+
+
+class MisskeyClient:  # pylint: disable=too-many-instance-attributes
+    """Client for interacting with the Misskey API."""
+
+    def __init__(self, instance: str, token: str):
+        self.instance = instance.rstrip("/")
+        self.token = token
+        self.base_url = f"{self.instance}/api"
+        self.streaming_url = f"{self.instance.replace('http', 'ws', 1)}/streaming"
+        self._stopped = asyncio.Event()
+        self._websocket: Optional[ClientConnection] = None
+        self.session: Optional[aiohttp.ClientSession] = None
+
+        # Short-lived cache for read-only requests, plus a longer-lived copy of
+        # each response to fall back on while the API is unreachable
+        self._cache: TTLCache = TTLCache(maxsize=128, ttl=5)
+        self._fallback_cache: TTLCache = TTLCache(maxsize=128, ttl=600)
+
+        self.attachment_cache = diskcache.Cache(
+            ATTACHMENT_CACHE_DIR, size_limit=ATTACHMENT_CACHE_SIZE
+        )
+
+    async def __aenter__(self):
+        self.session = create_session()
+        return self
+
+    async def __aexit__(self, *_exc_info):
+        await self.close()
+
+    async def close(self):
+        """Stop streaming and close the HTTP session and attachment cache."""
+        await self.stop_streaming()
+        if self.session is not None:
+            await self.session.close()
+        self.attachment_cache.close()
+
+    async def _make_request(
+        self, endpoint: str, data: Dict[str, Any], read_only: bool = False
+    ) -> Dict[str, Any]:
+        """Make a request to the Misskey API.
+
+        Every endpoint takes a POST, so ``read_only`` tells whether failed
+        requests can safely be retried.
+        """
+        url = f"{self.base_url}/{endpoint}"
+        data["i"] = self.token
+
+        async with await request_with_retries(
+            self.session, "POST", url, idempotent=read_only, json=data
+        ) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def _make_cached_request(self, endpoint: str, data: Dict[str, Any]) -> Any:
+        """Make a read-only request to the Misskey API, caching the response."""
+        key = (endpoint, frozenset(data.items()))
+        if key in self._cache:
+            return self._cache[key]
+
+        try:
+            result = await self._make_request(endpoint, dict(data), read_only=True)
+        except aiohttp.ClientError as e:
+            if key not in self._fallback_cache:
+                raise
+            logger.warning(
+                "Error requesting %s, using cached response: %s", endpoint, e
+            )
+            return self._fallback_cache[key]
+
+        self._cache[key] = result
+        self._fallback_cache[key] = result
+        return result
+
+    async def get_user_notes(
+        self,
+        user_id: str,
+        limit: int = 20,
+        since_id: Optional[str] = None,
+        cached: bool = True,
+    ) -> List[Dict[str, Any]]:
+        """Get notes (posts) from a specific user.
+
+        With ``cached``, the response may be served from the cache, or from a
+        stale copy when Misskey is unreachable. Callers that must not miss any
+        notes should disable it.
+        """
+        data = {
+            "userId": user_id,
+            "limit": limit,
+            "includeReplies": False,  # We don't want replies
+            "includeMyRenotes": False,  # We don't want renotes (quotes)
+        }
+
+        if since_id:
+            data["sinceId"] = since_id
+
+        if not cached:
+            return await self._make_request("users/notes", data, read_only=True)
+        return await self._make_cached_request("users/notes", data)
+
+    async def check_streamable_user(self, user_id: str):
+        """Make sure a user's notes are pushed to the token owner's home timeline.
+
+        That is the case for the token owner and the users they follow; notes of
+        anyone else would only be picked up when reconnecting.
+        """
+        me = await self._make_request("i", {}, read_only=True)
+        if me.get("id") == user_id:
+            return
+
+        relation = await self._make_request(
+            "users/relation", {"userId": user_id}, read_only=True
+        )
+        if not relation.get("isFollowing"):
+            raise ValueError(
+                f"Misskey user {user_id} must be the token owner or followed by them"
+            )
+
+    def _open_cached_attachment(
+        self, file_url: str
+    ) -> Optional[tuple[BinaryIO, str, str]]:
+        """Open a cached attachment, if both its metadata and body are cached."""
+        metadata = self.attachment_cache.get(file_url)
+        if metadata is None:
+            return None
+
+        body = self.attachment_cache.get(("body", file_url), read=True)
+        if body is None:
+            return None
+
+        return body, metadata["filename"], metadata["content_type"]
+
+    async def download_attachment(self, file_url: str) -> tuple[BinaryIO, str, str]:
+        """Download a file attachment from Misskey.
+
+        Attachments are streamed into a disk cache rather than read into memory,
+        and cached copies are revalidated with their ETag. A file-like object is
+        returned, which the caller is responsible for closing.
+        """
+        if not file_url.startswith("http"):
+            file_url = f"{self.instance}/{file_url.lstrip('/')}"
+
+        headers = {}
+        metadata = await asyncio.to_thread(self.attachment_cache.get, file_url)
+        if metadata is not None:
+            if metadata["etag"] is None:
+                cached = await asyncio.to_thread(self._open_cached_attachment, file_url)
+                if cached is not None:
+                    return cached
+            else:
+                headers["If-None-Match"] = metadata["etag"]
+
+        async with await request_with_retries(
+            self.session, "GET", file_url, headers=headers
+        ) as response:
+            if response.status == 304:
+                cached = await asyncio.to_thread(self._open_cached_attachment, file_url)
+                if cached is not None:
+                    return cached
+
+                # The body was evicted, so fetch it again unconditionally
+                await asyncio.to_thread(self.attachment_cache.delete, file_url)
+                return await self.download_attachment(file_url)
+
+            response.raise_for_status()
+
+            # The body is downloaded into an anonymous temporary file from a
+            # worker thread, and only handed to the cache once complete, so that
+            # failed or cancelled downloads leave no partial files behind
+            reader = HashingReader(
+                BlockingStreamReader(response.content, asyncio.get_running_loop())
+            )
+            with tempfile.TemporaryFile(dir=self.attachment_cache.directory) as tmp:
+                await asyncio.to_thread(shutil.copyfileobj, reader, tmp, CHUNK_SIZE)
+                tmp.seek(0)
+                await asyncio.to_thread(
+                    self.attachment_cache.set,
+                    ("body", file_url),
+                    tmp,
+                    read=True,
+                    expire=ATTACHMENT_CACHE_EXPIRY,
+                )
+
+            # Get the content type and name the file after its contents
+            content_type = response.headers.get(
+                "Content-Type", "application/octet-stream"
+            )
+            media_type = content_type.split(";", 1)[0].strip()
+            extension = (
+                _EXT.get(media_type) or mimetypes.guess_extension(media_type) or ""
+            )
+            filename = f"{reader.hasher.hexdigest()[:16]}{extension}"
+
+            await asyncio.to_thread(
+                self.attachment_cache.set,
+                file_url,
+                {
+                    "etag": response.headers.get("ETag"),
+                    "filename": filename,
+                    "content_type": content_type,
+                },
+                expire=ATTACHMENT_CACHE_EXPIRY,
+            )
+
+        body = await asyncio.to_thread(
+            self.attachment_cache.get, ("body", file_url), read=True
+        )
+        return body, filename, content_type
+
+    async def _channel_notes(
+        self, websocket: ClientConnection, channel_id: str
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """Yield notes pushed to a connected streaming channel.
+
+        Malformed messages are logged and skipped rather than ending the stream.
+        """
+        async for message in websocket:
+            try:
+                event = json.loads(message)
+            except ValueError as e:
+                logger.warning("Skipping malformed streaming message: %s", e)
+                continue
+            if not isinstance(event, dict) or event.get("type") != "channel":
+                continue
+
+            body = event.get("body")
+            if not isinstance(body, dict):
+                continue
+            if body.get("id") != channel_id or body.get("type") != "note":
+                continue
+
+            note = body.get("body")
+            if not isinstance(note, dict) or "id" not in note:
+                logger.warning("Skipping streamed note without an ID")
+                continue
+            yield note
+
+    async def stream_notes(
+        self, user_id: str, since_id: Optional[str] = None
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """Stream notes from a specific user in real-time.
+
+        Notes are pushed over Misskey's streaming API. Every time the connection
+        is (re)established, notes posted while it was down are fetched first.
+        """
+        backoff = 1
+
+        while not self._stopped.is_set():
+            try:
+                async with connect(f"{self.streaming_url}?i={self.token}") as websocket:
+                    self._websocket = websocket
+
+                    # Stopping during the handshake had no connection to close
+                    if self._stopped.is_set():
+                        break
+
+                    # The home timeline includes the user's own notes
+                    channel_id = str(uuid.uuid4())
+                    await websocket.send(
+                        json.dumps(
+                            {
+                                "type": "connect",
+                                "body": {
+                                    "channel": "homeTimeline",
+                                    "id": channel_id,
+                                    "params": {},
+                                },
+                            }
+                        )
+                    )
+
+                    # Catch up on notes posted while we were disconnected. A cached
+                    # response could predate them, and they would be skipped for good
+                    missed = await self.get_user_notes(
+                        user_id, limit=10, since_id=since_id, cached=False
+                    )
+                    backoff = 1
+
+                    async def notes() -> AsyncGenerator[Dict[str, Any], None]:
+                        for note in sorted(missed, key=lambda note: note["id"]):
+                            yield note
+                        async for note in self._channel_notes(websocket, channel_id):
+                            yield note
+
+                    async for note in notes():
+                        if note.get("userId") != user_id:
+                            continue
+                        if since_id is not None and note["id"] <= since_id:
+                            continue
+
+                        yield note
+                        since_id = note["id"]
+            except (WebSocketException, OSError, aiohttp.ClientError) as e:
+                logger.warning("Error streaming notes: %s", e)
+            finally:
+                self._websocket = None
+
+            # Back off exponentially before reconnecting, unless stopped meanwhile
+            try:
+                await asyncio.wait_for(self._stopped.wait(), backoff)
+            except TimeoutError:
+                backoff = min(backoff * 2, 30)
+
+    async def stop_streaming(self):
+        """Stop the note streaming."""
+        self._stopped.set()
+        if self._websocket is not None:
+            await self._websocket.close()
+
+
+class RateLimiter:
+    """Paces requests using the rate limit headers returned by Mastodon.
+
+    Every request takes one from the remaining budget before it is sent, so
+    that concurrent requests cannot overshoot it while their responses (and
+    thus fresh headers) are still outstanding.
+    """
+
+    def __init__(self):
+        self.remaining: Optional[int] = None
+        self.reset: float = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        """Wait until the rate limit allows another request."""
+        async with self._lock:
+            if self.remaining is None:
+                return
+
+            if self.remaining > 1:
+                self.remaining -= 1
+                return
+
+            # Hold the lock, so that other requests queue up behind this one
+            delay = self.reset - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            # The budget is unknown again until the next response arrives
+            self.remaining = None
+
+    def update(self, headers: Mapping[str, str]):
+        """Update the remaining budget from a response's headers."""
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset = headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+
+        try:
+            remaining_count = int(remaining)
+            reset_time = datetime.fromisoformat(reset).timestamp()
+        except ValueError:
+            return
+
+        # Responses to requests sent before others were counted report a stale
+        # budget, unless the rate limit window has moved on since
+        if self.remaining is not None and reset_time <= self.reset:
+            remaining_count = min(remaining_count, self.remaining)
+
+        self.remaining = remaining_count
+        self.reset = reset_time
+
+
+class MediaRejectedError(Exception):
+    """Raised when Mastodon rejects an upload with a client error (4xx)."""
+
+
+class MastodonClient:
+    """Client for interacting with the Mastodon API."""
+
+    def __init__(self, instance: str, token: str):
+        self.instance = instance.rstrip("/")
+        self.token = token
+        self.base_url = f"{self.instance}/api/v1"
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.rate_limiter = RateLimiter()
+
+    async def __aenter__(self):
+        self.session = create_session(self.headers)
+        return self
+
+    async def __aexit__(self, *_exc_info):
+        await self.close()
+
+    async def close(self):
+        """Close the underlying HTTP session."""
+        if self.session is not None:
+            await self.session.close()
+
+    async def _make_request(
+        self, method: str, endpoint: str, **kwargs
+    ) -> Dict[str, Any]:
+        """Make a request to the Mastodon API."""
+        url = f"{self.base_url}/{endpoint}"
+
+        await self.rate_limiter.wait()
+        async with await request_with_retries(
+            self.session, method, url, **kwargs
+        ) as response:
+            self.rate_limiter.update(response.headers)
+            response.raise_for_status()
+            content = await response.read()
+            return json.loads(content) if content else {}
+
+    async def upload_media(
+        self,
+        file: BinaryIO,
+        filename: str,
+        mime_type: str,
+        description: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """Upload media to Mastodon.
+
+        ``file`` is streamed to Mastodon in chunks rather than being buffered
+        in memory first. Raises MediaRejectedError if Mastodon refuses the
+        file itself, which retrying would not change.
+        """
+        endpoint = "media"
+
+        def form() -> aiohttp.FormData:
+            data = aiohttp.FormData()
+            if description:
+                data.add_field("description", description)
+            data.add_field(
+                "file", reopen_file(file), filename=filename, content_type=mime_type
+            )
+            return data
+
+        try:
+            return await self._make_request("POST", endpoint, data=form)
+        except aiohttp.ClientResponseError as e:
+            if 400 <= e.status < 500 and e.status != 429:
+                raise MediaRejectedError(f"Mastodon rejected {filename}: {e}") from e
+            raise
+
+    async def create_status(
+        self, text: str, media_ids: List[str] = None, visibility: str = "public", spoiler_text: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Create a new status (post) on Mastodon."""
+        endpoint = "statuses"
+
+        data = {
+            "status": text,
+            "visibility": visibility,
+            "content_type": "text/markdown",
+        }
+
+        if media_ids:
+            data["media_ids"] = media_ids
+
+        if spoiler_text:
+            data["spoiler_text"] = spoiler_text
+
+        return await self._make_request("POST", endpoint, json=data)
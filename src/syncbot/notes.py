@@ -0,0 +1,52 @@
+"""
+Note filtering and conversion helpers.
+
+These run against every streamed note, so they are kept free of I/O and fully
+annotated, allowing this module to be compiled with mypyc (see pyproject.toml).
+When it is not compiled, it is simply imported as pure Python.
+"""
+
+import re
+from types import MappingProxyType
+from typing import Any
+
+# Misskey visibility -> Mastodon visibility
+_VIS_MAP = MappingProxyType(
+    {
+        "public": "public",
+        "followers": "private",
+        "specified": "direct",
+        "home": "unlisted",
+    }
+)
+
+# An @ at the start of a word, as opposed to one inside an email address
+_MENTION_RE = re.compile(r"(?:^|\s)@\w")
+
+
+def should_crosspost(note: dict[str, Any]) -> bool:
+    """Determine if a note should be crossposted based on our criteria."""
+    # Don't crosspost if it's a reply
+    if note.get("replyId") is not None:
+        return False
+
+    # Don't crosspost if it's a quote (renote with text) or a renote
+    if note.get("renoteId") is not None:
+        return False
+
+    # Don't crosspost if it contains mentions
+    if note.get("mentions"):
+        return False
+
+    # Check if text contains something that looks like a mention, only running
+    # the pattern when the text contains an @ at all
+    text = note.get("text")
+    if text and "@" in text and _MENTION_RE.search(text):
+        return False
+
+    return True
+
+
+def misskey_to_mastodon_visibility(misskey_visibility: str) -> str:
+    """Convert Misskey visibility to Mastodon visibility."""
+    return _VIS_MAP.get(misskey_visibility, "public")